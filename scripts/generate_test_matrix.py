@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-import collections
-import glob
-import io
+import concurrent.futures
+import functools
+import html
 import json
 import os
 import subprocess
@@ -10,13 +10,24 @@ import sys
 import tempfile
 from typing import Any
 from typing import Dict
+from typing import FrozenSet
 from typing import List
 from typing import Optional
 from typing import Tuple
 
-from ruamel.yaml import YAML
+# orjson parses semgrep's JSON output several times faster than the
+# stdlib; fall back gracefully when it is not installed.
+try:
+    import orjson
 
-yaml = YAML(typ="rt")
+    def _json_loads(data: Any) -> Any:
+        return orjson.loads(data)
+
+
+except ImportError:
+
+    def _json_loads(data: Any) -> Any:
+        return json.loads(data)
 
 
 FEATURES = ["dots", "equivalence", "metavar", "misc"]
@@ -55,14 +66,14 @@ VERBOSE_SUBCATEGORY_NAME = {
 }
 
 LANGUAGE_EXCEPTIONS = {
-    "java": ["naming_import"],
-    "c": ["naming_import"],
-    "ruby": ["naming_import", "typed"],
-    "python": ["typed"],
-    "js": ["typed"],
+    "java": frozenset(["naming_import"]),
+    "c": frozenset(["naming_import"]),
+    "ruby": frozenset(["naming_import", "typed"]),
+    "python": frozenset(["typed"]),
+    "js": frozenset(["typed"]),
 }
 
-EXCLUDE = ["TODO", "POLYGLOT", "e2e", "OTHER"]
+EXCLUDE = frozenset(["TODO", "POLYGLOT", "e2e", "OTHER"])
 
 CHEATSHEET_ENTRIES = {
     "concrete": ["syntax"],
@@ -93,110 +104,177 @@ CHEATSHEET_ENTRIES = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def _listdir_set(dir_path: str) -> FrozenSet[str]:
+    # The same handful of directories is consulted for every cheatsheet
+    # cell; listing each once avoids thousands of redundant stat calls.
+    try:
+        return frozenset(os.listdir(dir_path))
+    except OSError:
+        return frozenset()
+
+
+def _path_exists(path: str) -> bool:
+    dir_path, filename = os.path.split(path)
+    return filename in _listdir_set(dir_path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_text(path: str) -> str:
+    # Every pattern file is needed both for the semgrep config and for the
+    # cheatsheet entry; cache so each file is read from disk once.
+    with open(path) as f:
+        return f.read()
+
+
 def find_path(
     root_dir: str, lang: str, category: str, subcategory: str, extension: str
 ):
-    base_path = os.path.join(root_dir, lang, f"{category}_{subcategory}")
-    joined = base_path + "." + extension
-    if os.path.exists(joined):
-        return joined
+    filename = f"{category}_{subcategory}.{extension}"
+    if filename in _listdir_set(os.path.join(root_dir, lang)):
+        return os.path.join(root_dir, lang, filename)
     else:
-        generic_base_path = os.path.join(
-            root_dir, "POLYGLOT", f"{category}_{subcategory}"
-        )
-        joined = generic_base_path + "." + extension
-        return joined
-
-
-def _single_pattern_to_dict(pattern: str, language: str) -> Dict[str, Any]:
-    pattern = pattern.strip()
-    if len(pattern.split("\n")) > 1:
-        pattern = (
-            pattern + "\n"
-        )  # make sure multi-line patterns end in new-line otherwise semgrep dies # TODO is this still true?
-
-    sgrep_config_default: Dict[str, Any] = {
-        "rules": [
-            {
-                "id": "default-example",
-                "patterns": [{"pattern": pattern}],
-                "message": "msg",
-                "languages": [language],
-                "severity": "WARNING",
-            }
-        ]
-    }
-    sgrep_config_default["rules"][0]["patterns"][0]["pattern"] = pattern
-    return sgrep_config_default
+        return os.path.join(root_dir, "POLYGLOT", filename)
 
 
-def _config_to_string(config: Any) -> str:
-    stream = io.StringIO()
-    yaml.dump(config, stream)
-    return stream.getvalue()
+def _pattern_to_rule_yaml(pattern: str, language: str, rule_id: str) -> str:
+    # The rule shape is fixed and the pattern corpus is plain printable
+    # text, so a block scalar template beats running a YAML serializer.
+    pattern_indented = "\n".join(
+        "      " + line for line in pattern.strip().splitlines()
+    )
+    return (
+        f"- id: {rule_id}\n"
+        f"  languages: [{language}]\n"
+        f"  severity: WARNING\n"
+        f"  message: msg\n"
+        f"  patterns:\n"
+        f"  - pattern: |\n"
+        f"{pattern_indented}\n"
+    )
 
 
-def run_semgrep_on_example(lang: str, config_arg_str: str, code_path: str) -> str:
-    with tempfile.NamedTemporaryFile("w") as config:
-        pattern_text = open(config_arg_str).read()
-        config.write(_config_to_string(_single_pattern_to_dict(pattern_text, lang)))
-        config.flush()
-        cmd = ["semgrep", "--json", f"--config={config.name}", code_path]
-        print(">>> " + " ".join(cmd))
+def run_semgrep_on_language(
+    lang: str, targets: List[Tuple[str, str, str]]
+) -> Dict[Tuple[str, str], List[Dict[str, Any]]]:
+    """Run semgrep once over all (rule_id, sgrep_path, code_path) targets.
+
+    Builds a single multi-rule config so semgrep startup is paid once per
+    language instead of once per cheatsheet cell. Returns the match ranges
+    keyed by (rule_id, code_path).
+    """
+    rules = []
+    code_paths: Dict[str, None] = {}  # de-duplicated, insertion-ordered
+    for rule_id, sgrep_path, code_path in targets:
+        rules.append(_pattern_to_rule_yaml(_read_text(sgrep_path), lang, rule_id))
+        code_paths[code_path] = None
+
+    config_str = "rules:\n" + "".join(rules)
+    # semgrep only reads configs from the filesystem (--config=- is not
+    # supported); one temp file per language keeps the batching win.
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as config_file:
+        config_file.write(config_str)
+        config_file.flush()
+        # --no-rewrite-rule-ids: semgrep otherwise prefixes check_ids with
+        # the config's directory, which would break the demux below.
+        cmd = [
+            "semgrep",
+            "--json",
+            "--no-rewrite-rule-ids",
+            f"--config={config_file.name}",
+        ] + list(code_paths)
+        if os.environ.get("SEMGREP_MATRIX_DEBUG"):
+            print(">>> " + " ".join(cmd))
         output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if output.returncode == 0:
-            print(output.stderr.decode("utf-8"))
-            return output.stdout.decode("utf-8")
-        else:
-            print("ERROR: " + str(output.returncode))
-            print(cmd)
-            sys.exit(1)
-
-
-def generate_cheatsheet(root_dir: str):
-    # output : {'dots': {'arguments': ['foo(...)', 'foo(1)'], } }
-    output = collections.defaultdict(
-        lambda: collections.defaultdict(lambda: collections.defaultdict(list))
-    )
+    if output.returncode != 0:
+        print("ERROR: " + str(output.returncode))
+        print(cmd)
+        print(output.stderr.decode("utf-8"))
+        sys.exit(1)
+
+    results: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for entry in _json_loads(output.stdout)["results"]:
+        # Normalize because semgrep emits str(Path(target)), which need not
+        # match the path string we passed (e.g. under a "./" root).
+        key = (entry["check_id"], os.path.normpath(entry["path"]))
+        results.setdefault(key, []).append(
+            {"start": entry["start"], "end": entry["end"]}
+        )
+    return results
+
+
+def generate_cheatsheet(root_dir: str, jobs: Optional[int] = None):
+    # output : {lang: {feature: {subcategory: {(pattern, pattern_path):
+    #           [(code, code_path, highlights), ...]}}}}
+    output: Dict[str, Dict[str, Dict[str, Dict[Tuple, list]]]] = {}
     langs = get_language_directories(root_dir)
+    # Paths are built by joining root_dir, so relative paths can be taken
+    # by slicing the prefix off rather than calling os.path.relpath.
+    root_prefix = os.path.normpath(root_dir) + os.sep
+
+    def relative_path(path: str) -> str:
+        if path.startswith(root_prefix):
+            return path[len(root_prefix) :]
+        return os.path.relpath(path, root_dir)
+
+    cells_by_lang: Dict[str, List[Tuple[str, str, str, str, str]]] = {}
     for lang in langs:
+        cells = []
+        # Skip excluded combinations up front so they cost no path lookups,
+        # file reads, or semgrep work at all.
+        exceptions = LANGUAGE_EXCEPTIONS.get(lang, frozenset())
         for category, subcategories in CHEATSHEET_ENTRIES.items():
+            feature_name = VERBOSE_FEATURE_NAME.get(category, category)
             for subcategory in subcategories:
-
+                if feature_name in exceptions or subcategory in exceptions:
+                    continue
                 sgrep_path = find_path(root_dir, lang, category, subcategory, "sgrep")
                 code_path = find_path(
                     root_dir, lang, category, subcategory, lang_dir_to_ext(lang)
                 )
-
-                highlights = []
-                if os.path.exists(sgrep_path) and os.path.exists(code_path):
-                    ranges = run_semgrep_on_example(lang, sgrep_path, code_path)
-                    if ranges:
-                        j = json.loads(ranges)
-                        for entry in j["results"]:
-                            highlights.append(
-                                {"start": entry["start"], "end": entry["end"]}
-                            )
-
-                entry = {
-                    "pattern": read_if_exists(sgrep_path),
-                    "pattern_path": os.path.relpath(sgrep_path, root_dir),
-                    "code": read_if_exists(code_path),
-                    "code_path": os.path.relpath(code_path, root_dir),
-                    "highlights": highlights,
-                }
-
-                feature_name = VERBOSE_FEATURE_NAME.get(category, category)
-                subcategory_name = VERBOSE_SUBCATEGORY_NAME.get(
-                    subcategory, subcategory
-                )
-                if category == "regexp" and subcategory == "string":
-                    subcategory_name = VERBOSE_REGEXP_SYNTAX
-                language_exception = feature_name in LANGUAGE_EXCEPTIONS.get(
-                    lang, []
-                ) or subcategory in LANGUAGE_EXCEPTIONS.get(lang, [])
-                if not language_exception:
-                    output[lang][feature_name][subcategory_name].append(entry)
+                rule_id = f"{category}__{subcategory}"
+                cells.append((rule_id, category, subcategory, sgrep_path, code_path))
+        cells_by_lang[lang] = cells
+
+    # The per-language semgrep runs are independent and spend their time
+    # blocked on the subprocess, so threads give near-linear speedup.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=jobs or os.cpu_count()
+    ) as executor:
+        futures = {}
+        for lang, cells in cells_by_lang.items():
+            runnable = [
+                (rule_id, sgrep_path, code_path)
+                for rule_id, _, _, sgrep_path, code_path in cells
+                if _path_exists(sgrep_path) and _path_exists(code_path)
+            ]
+            if runnable:
+                futures[lang] = executor.submit(run_semgrep_on_language, lang, runnable)
+        results_by_lang = {lang: future.result() for lang, future in futures.items()}
+
+    # Assemble the output sequentially so the nested dict is only ever
+    # mutated from one thread.
+    _feature_lookup = VERBOSE_FEATURE_NAME.get
+    _subcat_lookup = VERBOSE_SUBCATEGORY_NAME.get
+    for lang in langs:
+        results = results_by_lang.get(lang, {})
+        for rule_id, category, subcategory, sgrep_path, code_path in cells_by_lang[
+            lang
+        ]:
+            highlights = results.get((rule_id, os.path.normpath(code_path)), [])
+
+            # Group by pattern here so the HTML renderer does not need a
+            # second grouping pass over every entry.
+            pattern_key = (read_if_exists(sgrep_path), relative_path(sgrep_path))
+            snippet = (read_if_exists(code_path), relative_path(code_path), highlights)
+
+            feature_name = _feature_lookup(category, category)
+            subcategory_name = _subcat_lookup(subcategory, subcategory)
+            if category == "regexp" and subcategory == "string":
+                subcategory_name = VERBOSE_REGEXP_SYNTAX
+            output.setdefault(lang, {}).setdefault(feature_name, {}).setdefault(
+                subcategory_name, {}
+            ).setdefault(pattern_key, []).append(snippet)
 
     return output
 
@@ -257,64 +335,92 @@ h3 {
 """
 
 
+_PATTERN_TPL = '<div class="pattern"><a href="{p}"><pre>{t}</pre></a></div>'
+_MATCH_TPL = '<div class="match"><a href="{p}"><pre>{t}</pre></a></div>'
+
+
 def snippet_and_pattern_to_html(
-    sgrep_pattern: str, sgrep_path: str, code_snippets: List[Tuple[str, str]]
-):
-    s = ""
-    if sgrep_pattern:
-        s += f'<div class="pattern"><a href="{sgrep_path}"><pre>{sgrep_pattern}</pre></a></div>'
-        if len([x for x in code_snippets if x[0]]):
-            snippets_html = "".join(
-                [
-                    f'<div class="match"><a href="{path}"><pre>{snippet}</pre></a></div>'
-                    for snippet, path in code_snippets
-                ]
-            )
-            s += f"<div>{snippets_html}</div>"
-        else:
-            return f'<div class="notimplemented">This is missing an example!<br/>Or it doesn\'t work yet for this language!<br/>Edit {sgrep_path}</div>'
-    else:
+    sgrep_pattern: str, sgrep_path: str, code_snippets: List[Tuple[str, str, Any]]
+) -> str:
+    if not sgrep_pattern:
         return ""
-        s += f"<div>not implemented, no sgrep pattern at {sgrep_path}</div>"
-    return s
-
+    if not any(x[0] for x in code_snippets):
+        return f'<div class="notimplemented">This is missing an example!<br/>Or it doesn\'t work yet for this language!<br/>Edit {html.escape(sgrep_path)}</div>'
+    # Accumulate fragments in a list; += on str is quadratic in output size.
+    parts = [
+        _PATTERN_TPL.format_map(
+            {"p": html.escape(sgrep_path), "t": html.escape(sgrep_pattern)}
+        ),
+        "<div>",
+    ]
+    parts.extend(
+        _MATCH_TPL.format_map(
+            {"p": html.escape(path or ""), "t": html.escape(snippet or "")}
+        )
+        for snippet, path, _ in code_snippets
+    )
+    parts.append("</div>")
+    return "".join(parts)
 
-def wrap_in_div(L: List[str], className="") -> List[str]:
-    return "".join([f"<div class={className}>{i}</div>" for i in L])
 
+def wrap_in_div(L: List[str], className="") -> str:
+    return "".join(f"<div class={className}>{i}</div>" for i in L)
 
-def cheatsheet_to_html(cheatsheet: Dict[str, Any]):
 
-    s = ""
-    s += f"<head><style>{CSS}</style></head><body>"
+def cheatsheet_to_html_iter(cheatsheet: Dict[str, Any]):
+    # Yield the page in chunks so main() can stream it to the output file
+    # without materializing the whole document in memory.
+    yield f"<head><style>{CSS}</style></head><body>"
     for lang, categories in cheatsheet.items():
-        s += f"<h2>{lang}</h2>"
+        yield f"<h2>{lang}</h2>"
         for category, subcategories in categories.items():
             examples = []
             for subcategory, entries in subcategories.items():
-                by_pattern = collections.defaultdict(list)
-                for (sgrep_pattern, sgrep_path, code_snippet, code_path, _) in entries:
-                    by_pattern[(sgrep_pattern, sgrep_path)].append(
-                        (code_snippet, code_path)
-                    )
-
+                # Entries arrive already grouped by (pattern, pattern_path).
                 compiled_examples = [
                     snippet_and_pattern_to_html(pattern, pattern_path, snippets)
-                    for (pattern, pattern_path), snippets in by_pattern.items()
+                    for (pattern, pattern_path), snippets in entries.items()
                 ]
                 html = wrap_in_div(compiled_examples, className="pair")
                 examples.append(
                     f'<div class="example"><h3>{subcategory}</h3>{html}</div>'
                 )
-            s += f'<div class="example-category"><h2>{category}</h2><div class="examples">{"".join(examples)}</div></div>'
-    s += "</body>"
-    return s
+            yield f'<div class="example-category"><h2>{category}</h2><div class="examples">{"".join(examples)}</div></div>'
+    yield "</body>"
+
+
+def cheatsheet_to_html(cheatsheet: Dict[str, Any]) -> str:
+    return "".join(cheatsheet_to_html_iter(cheatsheet))
+
+
+def cheatsheet_to_json_shape(cheatsheet: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten the pattern-grouped cheatsheet into the entry-dict lists the
+    JSON output has always exposed (tuple keys are not serializable anyway)."""
+    return {
+        lang: {
+            feature: {
+                subcategory: [
+                    {
+                        "pattern": pattern,
+                        "pattern_path": pattern_path,
+                        "code": code,
+                        "code_path": code_path,
+                        "highlights": highlights,
+                    }
+                    for (pattern, pattern_path), snippets in entries.items()
+                    for code, code_path, highlights in snippets
+                ]
+                for subcategory, entries in subcategories.items()
+            }
+            for feature, subcategories in features.items()
+        }
+        for lang, features in cheatsheet.items()
+    }
 
 
 def read_if_exists(path: Optional[str]):
-    if path and os.path.exists(path):
-        text = str(open(path).read())
-        return text
+    if path and _path_exists(path):
+        return _read_text(path)
 
 
 def lang_dir_to_ext(lang: str):
@@ -356,20 +462,25 @@ def print_to_html(stats):
 
 def compute_stats(dir_name: str, lang_dir: str):
     path = os.path.join(dir_name, lang_dir)
-    count_per_feature = {}
-    for f in FEATURES:
-        count_per_feature[f] = len(
-            glob.glob1(path, f"{f}*.{lang_dir_to_ext(lang_dir)}")
-        )
+    ext = "." + lang_dir_to_ext(lang_dir)
+    count_per_feature = {f: 0 for f in FEATURES}
+    # One scandir pass instead of one glob (and directory scan) per feature.
+    for entry in os.scandir(path):
+        name = entry.name
+        if not name.endswith(ext):
+            continue
+        for f in FEATURES:
+            if name.startswith(f):
+                count_per_feature[f] += 1
+                break
     return count_per_feature
 
 
 def get_language_directories(dir_name: str) -> List[str]:
-    files = os.listdir(dir_name)
     return [
-        f
-        for f in files
-        if os.path.isdir(os.path.join(dir_name, f)) and not f in EXCLUDE
+        entry.name
+        for entry in os.scandir(dir_name)
+        if entry.is_dir(follow_symlinks=False) and entry.name not in EXCLUDE
     ]
 
 
@@ -396,6 +507,13 @@ def parse_args():
         help="output to this file",
     )
 
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of semgrep invocations to run in parallel",
+    )
+
     output_group = p.add_mutually_exclusive_group(required=True)
     output_group.add_argument("-j", "--json", action="store_true", help="output JSON")
     output_group.add_argument("-t", "--html", action="store_true", help="output HTML")
@@ -408,17 +526,20 @@ def parse_args():
 def main() -> None:
     args = parse_args()
 
-    cheatsheet = generate_cheatsheet(args.directory)
+    cheatsheet = generate_cheatsheet(args.directory, jobs=args.jobs)
 
+    # Stream the output instead of materializing the full serialized
+    # document next to the cheatsheet dict.
+    out = args.output_file or sys.stdout
     if args.json:
-        output = json.dumps(cheatsheet, indent=4, separators=(",", ": "))
+        json.dump(
+            cheatsheet_to_json_shape(cheatsheet), out, indent=4, separators=(",", ": ")
+        )
     elif args.html:
-        output = cheatsheet_to_html(cheatsheet)
-
-    if args.output_file:
-        args.output_file.write(output)
-    else:
-        print(output)
+        for chunk in cheatsheet_to_html_iter(cheatsheet):
+            out.write(chunk)
+    if out is sys.stdout:
+        out.write("\n")
 
 
 if __name__ == "__main__":